@@ -5,11 +5,14 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+import redis.asyncio as aioredis
 from datetime import datetime, timezone
 import os
 from dotenv import load_dotenv
-from typing import Union
+from typing import List, Union
 from pydantic import BaseModel
 
 # Load environment variables from .env file
@@ -22,12 +25,37 @@ database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    # One client per process; its pool is shared by every request in this worker
+    _client = AsyncIOMotorClient(
+        database_url,
+        maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", "200")),
+        minPoolSize=int(os.getenv("MONGO_MIN_POOL_SIZE", "20")),
+        waitQueueTimeoutMS=int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "2000")),
+        serverSelectionTimeoutMS=int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "3000")),
+        retryWrites=True,
+        compressors=os.getenv("MONGO_COMPRESSORS", "zstd,zlib"),
+    )
     db = _client[database_name]
 
+# Optional Redis cache for hot reads; left as None when REDIS_URL is not set
+cache = None
+
+redis_url = os.getenv("REDIS_URL")
+
+if redis_url:
+    cache = aioredis.Redis.from_url(redis_url, socket_timeout=0.5, socket_connect_timeout=0.5)
+
+class PartialInsertError(Exception):
+    """Raised when an unordered bulk insert stored only some of the documents"""
+
+    def __init__(self, inserted: List[dict], errors: List[dict]):
+        super().__init__(f"{len(errors)} documents were not inserted")
+        self.inserted = inserted
+        self.errors = errors
+
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
-    """Insert a single document with timestamp"""
+async def insert_document(collection_name: str, data: Union[BaseModel, dict]) -> dict:
+    """Insert a single document with timestamp and return it as stored"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
 
@@ -40,10 +68,45 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     data_dict['created_at'] = datetime.now(timezone.utc)
     data_dict['updated_at'] = datetime.now(timezone.utc)
 
-    result = db[collection_name].insert_one(data_dict)
-    return str(result.inserted_id)
+    # Generate the id client-side so callers don't need a follow-up read
+    data_dict['_id'] = ObjectId()
+
+    await db[collection_name].insert_one(data_dict)
+    return data_dict
+
+async def insert_documents(collection_name: str, items: List[Union[BaseModel, dict]]) -> List[dict]:
+    """Insert many documents with timestamps in one round-trip and return them as stored"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    now = datetime.now(timezone.utc)
+    docs = []
+    for data in items:
+        data_dict = data.model_dump() if isinstance(data, BaseModel) else data.copy()
+        data_dict['created_at'] = now
+        data_dict['updated_at'] = now
+        data_dict['_id'] = ObjectId()
+        docs.append(data_dict)
+
+    if docs:
+        try:
+            await db[collection_name].insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if not errors:
+                # Only write-concern errors: every document was written, so this isn't a partial insert
+                raise
+            failed = {err["index"] for err in errors}
+            inserted = [d for i, d in enumerate(docs) if i not in failed]
+            raise PartialInsertError(inserted, errors) from e
+    return docs
+
+async def create_document(collection_name: str, data: Union[BaseModel, dict]):
+    """Insert a single document with timestamp"""
+    doc = await insert_document(collection_name, data)
+    return str(doc['_id'])
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
     """Get documents from collection"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -52,4 +115,4 @@ def get_documents(collection_name: str, filter_dict: dict = None, limit: int = N
     if limit:
         cursor = cursor.limit(limit)
     
-    return list(cursor)
+    return await cursor.to_list(length=limit)
@@ -1,67 +1,195 @@
 import os
+import logging
+import re
+import asyncio
+import hashlib
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta, timezone
-from typing import Optional, Literal, Any, Dict
-from fastapi import FastAPI, HTTPException, Query, Header, Depends
+from typing import Optional, Literal, Any, Dict, List
+from fastapi import FastAPI, HTTPException, Query, Header, Depends, Body
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel, EmailStr
 from bson import ObjectId
+from bson.errors import InvalidId
+from cachetools import TTLCache
 
-from database import db, create_document
+from database import db, cache, insert_document, insert_documents, PartialInsertError
 from schemas import Vendor, Payment, User, UserOut, LoginRequest
-from pymongo import GEOSPHERE, ASCENDING
-from passlib.context import CryptContext
+from pymongo import GEOSPHERE, ASCENDING, IndexModel, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from passwords import pwd_context, hash_password_sync, verify_password_sync
 import jwt
+import orjson
 
-app = FastAPI(title="Madad MVP API")
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="Madad MVP API", default_response_class=ORJSONResponse)
+
+# Comma-separated origin allowlist; unset keeps the open "*" policy
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "").split(",") if o.strip()]
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=CORS_ORIGINS or ["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=int(os.getenv("CORS_MAX_AGE", "600")),
 )
 
 # Config
 JWT_SECRET = os.getenv("JWT_SECRET", "dev_secret_change_me")
 JWT_ALGO = os.getenv("JWT_ALGO", "HS256")
+JWT_SECRET_BYTES = JWT_SECRET.encode("utf-8")
+JWT_ALGORITHMS = [JWT_ALGO]
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "43200"))  # 30 days by default
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", "300"))  # seconds
+VENDOR_CACHE_TTL = int(os.getenv("VENDOR_CACHE_TTL", "60"))  # seconds
+_jwt = jwt.PyJWT()
+_JWT_DECODE_OPTIONS = {"require": ["exp", "sub"]}
+_pw_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _new_password_pool() -> ProcessPoolExecutor:
+    # forkserver: don't fork workers from a process already running Motor/pymongo threads
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("forkserver"))
+
+
+@app.on_event("startup")
+def start_password_pool():
+    global _pw_pool
+    _pw_pool = _new_password_pool()
+
+
+@app.on_event("shutdown")
+def stop_password_pool():
+    if _pw_pool is not None:
+        _pw_pool.shutdown(wait=False, cancel_futures=True)
+
+
+@app.on_event("shutdown")
+async def close_cache():
+    if cache is not None:
+        await cache.aclose()
+
 
 # Indexes
-if db is not None:
+INDEXES: Dict[str, List[IndexModel]] = {
+    "vendor": [
+        IndexModel([("location", GEOSPHERE)], name="location_2dsphere"),
+        IndexModel(
+            [("approved", ASCENDING), ("payment_status", ASCENDING), ("service_type", ASCENDING)],
+            name="approved_1_payment_status_1_service_type_1",
+        ),
+    ],
+    "user": [
+        IndexModel([("email", ASCENDING)], name="email_1", unique=True, sparse=True),
+        IndexModel([("phone", ASCENDING)], name="phone_1", unique=True, sparse=True),
+    ],
+}
+
+
+@app.on_event("startup")
+async def ensure_indexes():
+    # Deployments that build indexes in a separate job can set SKIP_INDEX_INIT=1
+    if db is None or os.getenv("SKIP_INDEX_INIT") == "1":
+        return
+    for collection, models in INDEXES.items():
+        # One collection failing (e.g. a conflicting index) must not skip the others
+        try:
+            existing = await db[collection].index_information()
+            missing = [m for m in models if m.document["name"] not in existing]
+            if missing:
+                await db[collection].create_indexes(missing)
+        except Exception as e:
+            logger.warning("Index setup failed for %s: %s", collection, e)
+
+
+_OID_RE = re.compile(r"[0-9a-f]{24}", re.IGNORECASE)
+
+def _vendor_cache_key(vendor_id: str) -> str:
+    return f"v:{vendor_id.lower()}"
+
+
+# After a Redis error, skip the cache for a while so an unreachable server doesn't add timeouts to every request
+CACHE_BACKOFF_SECONDS = 30.0
+_cache_skip_until = 0.0
+
+
+def _cache_available() -> bool:
+    return cache is not None and time.monotonic() >= _cache_skip_until
+
+
+def _cache_failed() -> None:
+    global _cache_skip_until
+    _cache_skip_until = time.monotonic() + CACHE_BACKOFF_SECONDS
+
+
+async def _cache_vendor(key: str, body: bytes) -> None:
+    if not _cache_available():
+        return
     try:
-        db["vendor"].create_index([("location", GEOSPHERE)])
-        db["user"].create_index([("email", ASCENDING)], unique=True, sparse=True)
-        db["user"].create_index([("phone", ASCENDING)], unique=True, sparse=True)
+        await cache.setex(key, VENDOR_CACHE_TTL, body)
     except Exception:
-        pass
+        _cache_failed()
+
+
+# Fields returned by the public nearby search
+NEARBY_PROJECTION = {
+    "name": 1,
+    "phone": 1,
+    "service_type": 1,
+    "location": 1,
+    "address": 1,
+    "approved": 1,
+    "payment_status": 1,
+    "distance_m": 1,
+}
 
 
 def serialize_doc(doc: Dict[str, Any]) -> Dict[str, Any]:
+    # Mutates in place: callers pass fresh driver dicts, never shared/cached ones
     if not doc:
         return doc
-    doc = dict(doc)
     _id = doc.get("_id")
-    if isinstance(_id, ObjectId):
+    if _id.__class__ is ObjectId:
         doc["id"] = str(_id)
         del doc["_id"]
     return doc
 
 
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+async def _run_in_password_pool(fn, *args):
+    # Password hashing is CPU-bound; run it in worker processes so the GIL doesn't serialize logins
+    global _pw_pool
+    loop = asyncio.get_running_loop()
+    pool = _pw_pool
+    try:
+        return await loop.run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed); replace the pool once and retry
+        if _pw_pool is pool:
+            _pw_pool = _new_password_pool()
+            pool.shutdown(wait=False)
+        return await loop.run_in_executor(_pw_pool, fn, *args)
+
+
+async def hash_password(password: str) -> str:
+    return await _run_in_password_pool(hash_password_sync, password)
 
 
-def verify_password(password: str, hashed: str) -> bool:
-    return pwd_context.verify(password, hashed)
+async def verify_password(password: str, hashed: str) -> bool:
+    return await _run_in_password_pool(verify_password_sync, password, hashed)
 
 
 def create_access_token(sub: str) -> str:
     now = datetime.now(timezone.utc)
     exp = now + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     payload = {"sub": sub, "exp": exp}
-    token = jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGO)
+    token = _jwt.encode(payload, JWT_SECRET_BYTES, algorithm=JWT_ALGO)
     return token
 
 
@@ -76,28 +204,46 @@ class UpdateVendor(BaseModel):
 
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"name": "Madad API", "status": "ok"}
 
 
+@app.get("/health")
+async def health():
+    if db is None:
+        return ORJSONResponse({"status": "error", "database": "not configured"}, status_code=503)
+    try:
+        await db.command("ping")
+    except Exception as e:
+        return ORJSONResponse({"status": "error", "database": str(e)[:120]}, status_code=503)
+    return {"status": "ok"}
+
+
+_TEST_RESPONSE = {
+    "backend": "✅ Running",
+    "database": "❌ Not Available",
+    "database_url": "❌ Not Set",
+    "database_name": "❌ Not Set",
+    "connection_status": "Not Connected",
+    "collections": [],
+}
+COLLECTIONS_CACHE_TTL = 30.0  # seconds
+_cols_cache: Dict[str, Any] = {"t": 0.0, "v": []}
+
+
 @app.get("/test")
-def test_database():
-    response = {
-        "backend": "✅ Running",
-        "database": "❌ Not Available",
-        "database_url": "❌ Not Set",
-        "database_name": "❌ Not Set",
-        "connection_status": "Not Connected",
-        "collections": [],
-    }
+async def test_database():
+    response = _TEST_RESPONSE.copy()
     try:
         if db is not None:
             response["database"] = "✅ Available"
             response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
             response["database_name"] = os.getenv("DATABASE_NAME") or "❌ Not Set"
             try:
-                cols = db.list_collection_names()
-                response["collections"] = cols
+                if time.monotonic() - _cols_cache["t"] > COLLECTIONS_CACHE_TTL:
+                    _cols_cache["v"] = await db.list_collection_names()
+                    _cols_cache["t"] = time.monotonic()
+                response["collections"] = _cols_cache["v"]
                 response["database"] = "✅ Connected & Working"
                 response["connection_status"] = "Connected"
             except Exception as e:
@@ -116,41 +262,73 @@ class TokenResponse(BaseModel):
     user: UserOut
 
 
-def get_current_user(authorization: Optional[str] = Header(None)) -> Optional[Dict[str, Any]]:
+# Token digest -> (user doc or None for rejected tokens, expiry timestamp)
+_auth_cache: TTLCache = TTLCache(maxsize=10000, ttl=AUTH_CACHE_TTL)
+
+
+async def get_current_user(authorization: Optional[str] = Header(None)) -> Optional[Dict[str, Any]]:
     if not authorization or not authorization.lower().startswith("bearer "):
         return None
     token = authorization.split(" ", 1)[1].strip()
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    now = time.time()
+    cached = _auth_cache.get(key)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+
+    expires = now + AUTH_CACHE_TTL
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGO])
-        sub = payload.get("sub")
-        if not sub or db is None:
-            return None
-        doc = db["user"].find_one({"_id": ObjectId(sub)})
-        return doc
+        payload = _jwt.decode(token, JWT_SECRET_BYTES, algorithms=JWT_ALGORITHMS, options=_JWT_DECODE_OPTIONS)
+        oid = ObjectId(payload["sub"])
+    except (jwt.PyJWTError, KeyError, TypeError, InvalidId):
+        _auth_cache[key] = (None, expires)
+        return None
+    if db is None:
+        return None
+    try:
+        doc = await db["user"].find_one({"_id": oid}, projection={"hashed_password": 0})
     except Exception:
+        # Transient DB errors must not pin the token as rejected
         return None
+    exp = payload.get("exp")
+    if isinstance(exp, (int, float)):
+        expires = min(expires, exp)
+    _auth_cache[key] = (doc, expires)
+    return doc
+
+
+LOGIN_PROJECTION = {"name": 1, "email": 1, "phone": 1, "hashed_password": 1}
 
 
 @app.post("/api/auth/register", response_model=TokenResponse)
-def register(user: User):
+async def register(user: User):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
     # Ensure either email or phone present
     if not user.email and not user.phone:
         raise HTTPException(status_code=400, detail="Email or phone is required")
-    # Uniqueness checks
-    if user.email and db["user"].find_one({"email": user.email}):
-        raise HTTPException(status_code=409, detail="Email already registered")
-    if user.phone and db["user"].find_one({"phone": user.phone}):
+    # Uniqueness checks (one query; unique indexes catch races at insert)
+    conds = []
+    if user.email:
+        conds.append({"email": user.email})
+    if user.phone:
+        conds.append({"phone": user.phone})
+    existing = await db["user"].find_one({"$or": conds}, projection={"email": 1})
+    if existing:
+        if user.email and existing.get("email") == user.email:
+            raise HTTPException(status_code=409, detail="Email already registered")
         raise HTTPException(status_code=409, detail="Phone already registered")
 
     data = user.model_dump()
     raw_password = data.pop("password")
-    data["hashed_password"] = hash_password(raw_password)
-    data["created_at"] = datetime.now(timezone.utc)
-    data["updated_at"] = datetime.now(timezone.utc)
+    data["hashed_password"] = await hash_password(raw_password)
+    now = datetime.now(timezone.utc)
+    data["created_at"] = data["updated_at"] = now
 
-    res = db["user"].insert_one(data)
+    try:
+        res = await db["user"].insert_one(data)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Already registered")
     uid = str(res.inserted_id)
 
     token = create_access_token(uid)
@@ -159,19 +337,26 @@ def register(user: User):
 
 
 @app.post("/api/auth/login", response_model=TokenResponse)
-def login(req: LoginRequest):
+async def login(req: LoginRequest):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
     if not req.email and not req.phone:
         raise HTTPException(status_code=400, detail="Email or phone is required")
 
     q: Dict[str, Any] = {"email": req.email} if req.email else {"phone": req.phone}
-    doc = db["user"].find_one(q)
+    doc = await db["user"].find_one(q, projection=LOGIN_PROJECTION)
     if not doc:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     hashed = doc.get("hashed_password")
-    if not hashed or not verify_password(req.password, hashed):
+    if not hashed or not await verify_password(req.password, hashed):
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if pwd_context.needs_update(hashed):
+        # Best-effort upgrade; a failure here must not block a valid sign-in
+        try:
+            new_hash = await hash_password(req.password)
+            await db["user"].update_one({"_id": doc["_id"]}, {"$set": {"hashed_password": new_hash}})
+        except Exception:
+            pass
     uid = str(doc["_id"])
 
     token = create_access_token(uid)
@@ -180,61 +365,28 @@ def login(req: LoginRequest):
 
 
 @app.get("/api/auth/me", response_model=UserOut)
-def me(current = Depends(get_current_user)):
+async def me(current = Depends(get_current_user)):
     if not current:
         raise HTTPException(status_code=401, detail="Unauthorized")
-    doc = serialize_doc(current)
-    return UserOut(id=doc["id"], name=doc.get("name"), email=doc.get("email"), phone=doc.get("phone"))
+    # current may be shared through the auth cache, so read it without mutating
+    return UserOut(
+        id=str(current["_id"]), name=current.get("name"), email=current.get("email"), phone=current.get("phone")
+    )
 
 
 # ---------- VENDORS ----------
 @app.post("/api/vendors")
-def create_vendor(vendor: Vendor, current = Depends(get_current_user)):
+async def create_vendor(vendor: Vendor, current = Depends(get_current_user)):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
     if not current:
         raise HTTPException(status_code=401, detail="Unauthorized")
-    vid = create_document("vendor", vendor)
-    doc = db["vendor"].find_one({"_id": ObjectId(vid)})
+    doc = await insert_document("vendor", vendor)
     return serialize_doc(doc)
 
 
-@app.get("/api/vendors/{vendor_id}")
-def get_vendor(vendor_id: str):
-    if db is None:
-        raise HTTPException(status_code=500, detail="Database not available")
-    try:
-        doc = db["vendor"].find_one({"_id": ObjectId(vendor_id)})
-        if not doc:
-            raise HTTPException(status_code=404, detail="Vendor not found")
-        return serialize_doc(doc)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid vendor id")
-
-
-@app.patch("/api/vendors/{vendor_id}")
-def update_vendor(vendor_id: str, payload: "UpdateVendor", current = Depends(get_current_user)):
-    if db is None:
-        raise HTTPException(status_code=500, detail="Database not available")
-    if not current:
-        raise HTTPException(status_code=401, detail="Unauthorized")
-    try:
-        update = {k: v for k, v in payload.model_dump(exclude_none=True).items()}
-        if not update:
-            return {"updated": False}
-        res = db["vendor"].update_one({"_id": ObjectId(vendor_id)}, {"$set": update})
-        if res.matched_count == 0:
-            raise HTTPException(status_code=404, detail="Vendor not found")
-        doc = db["vendor"].find_one({"_id": ObjectId(vendor_id)})
-        return serialize_doc(doc)
-    except HTTPException:
-        raise
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid vendor id")
-
-
 @app.get("/api/vendors/nearby")
-def nearby_vendors(
+async def nearby_vendors(
     lng: float = Query(..., description="Longitude"),
     lat: float = Query(..., description="Latitude"),
     radius_km: float = Query(5.0, description="Search radius in kilometers"),
@@ -243,28 +395,81 @@ def nearby_vendors(
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
 
-    query: Dict[str, Any] = {
-        "location": {
-            "$near": {
-                "$geometry": {"type": "Point", "coordinates": [lng, lat]},
-                "$maxDistance": int(radius_km * 1000),
+    query: Dict[str, Any] = {"approved": True, "payment_status": "active"}
+    if service_type:
+        query["service_type"] = service_type
+
+    # $geoNear applies the filter during the index scan instead of after sorting by distance
+    pipeline = [
+        {
+            "$geoNear": {
+                "near": {"type": "Point", "coordinates": [lng, lat]},
+                "distanceField": "distance_m",
+                "maxDistance": int(radius_km * 1000),
+                "query": query,
+                "spherical": True,
             }
         },
-        "approved": True,
-        "payment_status": "active",
-    }
+        {"$limit": 200},
+        {"$project": NEARBY_PROJECTION},
+    ]
+    cursor = db["vendor"].aggregate(pipeline, batchSize=200, allowDiskUse=False)
+    docs = await cursor.to_list(length=200)
+    for d in docs:
+        serialize_doc(d)
+    return {"count": len(docs), "vendors": docs}
 
-    if service_type:
-        query["service_type"] = service_type
 
-    cursor = db["vendor"].find(query).limit(200)
-    results = [serialize_doc(doc) for doc in cursor]
-    return {"count": len(results), "vendors": results}
+@app.get("/api/vendors/{vendor_id}")
+async def get_vendor(vendor_id: str):
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    if not _OID_RE.fullmatch(vendor_id):
+        raise HTTPException(status_code=400, detail="Invalid vendor id")
+    key = _vendor_cache_key(vendor_id)
+    if _cache_available():
+        try:
+            cached = await cache.get(key)
+        except Exception:
+            _cache_failed()
+            cached = None
+        if cached:
+            return Response(cached, media_type="application/json")
+    doc = await db["vendor"].find_one({"_id": ObjectId(vendor_id)})
+    if not doc:
+        raise HTTPException(status_code=404, detail="Vendor not found")
+    body = orjson.dumps(serialize_doc(doc))
+    await _cache_vendor(key, body)
+    return Response(body, media_type="application/json")
+
+
+@app.patch("/api/vendors/{vendor_id}")
+async def update_vendor(vendor_id: str, payload: "UpdateVendor", current = Depends(get_current_user)):
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    if not current:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if not _OID_RE.fullmatch(vendor_id):
+        raise HTTPException(status_code=400, detail="Invalid vendor id")
+    oid = ObjectId(vendor_id)
+    update = payload.model_dump(exclude_none=True)
+    if not update:
+        return {"updated": False}
+    doc = await db["vendor"].find_one_and_update(
+        {"_id": oid}, {"$set": update}, return_document=ReturnDocument.AFTER
+    )
+    if doc is None:
+        raise HTTPException(status_code=404, detail="Vendor not found")
+    doc = serialize_doc(doc)
+    # Write the post-update body rather than deleting the key. A get_vendor that read the old
+    # document can still land its setex after this one, leaving it stale for up to VENDOR_CACHE_TTL.
+    await _cache_vendor(_vendor_cache_key(vendor_id), orjson.dumps(doc))
+    return doc
 
 
 # Admin list (left open for now)
 @app.get("/api/admin/vendors")
-def admin_list_vendors(status: Optional[str] = Query(None, description="pending|active|all")):
+async def admin_list_vendors(status: Optional[str] = Query(None, description="pending|active|all")):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
     q: Dict[str, Any] = {}
@@ -272,22 +477,62 @@ def admin_list_vendors(status: Optional[str] = Query(None, description="pending|
         q = {"approved": False}
     elif status == "active":
         q = {"approved": True, "payment_status": "active"}
-    cursor = db["vendor"].find(q).limit(500)
-    return [serialize_doc(d) for d in cursor]
+    cursor = db["vendor"].find(q).limit(500).batch_size(100)
+    # Read the first batch here so connection/query errors still surface as a 5xx
+    head = await cursor.to_list(length=100)
+
+    # Stream the rest batch by batch instead of materializing all 500 docs first.
+    # Once the first chunk is sent the status is committed; later errors can only abort the connection.
+    async def gen():
+        yield b"[" + b",".join(orjson.dumps(serialize_doc(d)) for d in head)
+        first = not head
+        if len(head) == 100:
+            async for d in cursor:
+                yield (b"" if first else b",") + orjson.dumps(serialize_doc(d))
+                first = False
+        yield b"]"
+
+    return StreamingResponse(gen(), media_type="application/json")
 
 
 # Payments
 @app.post("/api/payments")
-def create_payment(payment: Payment, current = Depends(get_current_user)):
+async def create_payment(payment: Payment, current = Depends(get_current_user)):
     if db is None:
         raise HTTPException(status_code=500, detail="Database not available")
     if not current:
         raise HTTPException(status_code=401, detail="Unauthorized")
-    pid = create_document("payment", payment)
-    doc = db["payment"].find_one({"_id": ObjectId(pid)})
+    doc = await insert_document("payment", payment)
     return serialize_doc(doc)
 
 
+MAX_BULK_PAYMENTS = 500
+
+
+@app.post("/api/payments/bulk")
+async def create_payments(
+    payments: List[Payment] = Body(..., max_length=MAX_BULK_PAYMENTS),
+    current = Depends(get_current_user),
+):
+    if db is None:
+        raise HTTPException(status_code=500, detail="Database not available")
+    if not current:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    try:
+        docs = await insert_documents("payment", payments)
+    except PartialInsertError as e:
+        # Unordered insert: every document without a write error was stored
+        raise HTTPException(
+            status_code=409 if all(err.get("code") == 11000 for err in e.errors) else 500,
+            detail={
+                "message": f"{len(e.errors)} of {len(payments)} payments were not inserted",
+                "inserted_ids": [str(d["_id"]) for d in e.inserted],
+                "failed": [{"index": err["index"], "error": err.get("errmsg")} for err in e.errors],
+            },
+        )
+    return {"count": len(docs), "payments": [serialize_doc(d) for d in docs]}
+
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
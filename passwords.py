@@ -0,0 +1,26 @@
+"""
+Password Hashing
+
+Kept separate from main.py so password-pool worker processes only import passlib,
+not the app, its Mongo client or its Redis client.
+"""
+
+from passlib.context import CryptContext
+
+# New hashes use argon2id; legacy bcrypt hashes still verify and get upgraded on login
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    default="argon2",
+    deprecated="auto",
+    argon2__memory_cost=19456,
+    argon2__time_cost=2,
+    argon2__parallelism=1,
+)
+
+
+def hash_password_sync(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def verify_password_sync(password: str, hashed: str) -> bool:
+    return pwd_context.verify(password, hashed)
@@ -10,9 +10,12 @@ Collections:
 - Payment: records of vendor subscription payments (MVP: manual status tracking)
 """
 
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import BaseModel, ConfigDict, Field, EmailStr
 from typing import Optional, Literal, List
 
+# Request bodies are read-only once parsed; unknown fields are dropped
+RequestConfig = ConfigDict(extra="ignore", frozen=True)
+
 ServiceType = Literal[
     "tow_truck",
     "mechanic",
@@ -29,6 +32,8 @@ class GeoPoint(BaseModel):
     coordinates: List[float] = Field(..., min_items=2, max_items=2, description="[lng, lat]")
 
 class User(BaseModel):
+    model_config = RequestConfig
+
     name: Optional[str] = None
     email: Optional[EmailStr] = None
     phone: Optional[str] = None
@@ -41,11 +46,15 @@ class UserOut(BaseModel):
     phone: Optional[str] = None
 
 class LoginRequest(BaseModel):
+    model_config = RequestConfig
+
     email: Optional[EmailStr] = None
     phone: Optional[str] = None
     password: str
 
 class Vendor(BaseModel):
+    model_config = RequestConfig
+
     name: str = Field(..., description="Vendor display name")
     phone: str = Field(..., description="Primary contact phone number in local format")
     service_type: ServiceType = Field(..., description="Primary service category")
@@ -57,6 +66,8 @@ class Vendor(BaseModel):
     payment_status: Literal["unpaid", "active", "expired"] = Field("unpaid")
 
 class Payment(BaseModel):
+    model_config = RequestConfig
+
     vendor_id: str = Field(..., description="Reference to vendor _id as string")
     amount_pkr: int = Field(..., ge=0)
     method: Literal["easypaisa", "jazzcash", "manual"] = "manual"